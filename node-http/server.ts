@@ -36,7 +36,22 @@ express()
     .use("/", express.static("../../ui/dist"))
     .post("/query", (req, res) => {
         try {
-            const query = unpackr.unpack(req.body as Buffer) as { query: string, params: (null | bigint | number | string | Buffer)[], mode: "r" | "w+" }
+            const body = unpackr.unpack(req.body as Buffer) as { batch: [string, (null | bigint | number | string | Buffer)[]][], mode: "w+" } | { query: string, params: (null | bigint | number | string | Buffer)[], mode: "r" | "w+" }
+            if ("batch" in body) {
+                if (body.mode !== "w+") { throw new Error(`Invalid arguments`) }
+                readWriteConnection.transaction(() => {
+                    for (const [query, params] of body.batch) {
+                        try {
+                            readWriteConnection.prepare(query).run(...params)
+                        } catch (err) {
+                            throw new Error(`${(err as Error).message}\nQuery: ${query}\nParams: [${params.map((x) => "" + x).join(", ")}]`)
+                        }
+                    }
+                })()
+                res.send(packr.pack(undefined))
+                return
+            }
+            const query = body
 
             if (typeof query.query !== "string") { throw new Error(`Invalid arguments`) }
             if (!(Array.isArray(query.params) && query.params.every((p) => p === null || typeof p === "number" || typeof p === "bigint" || typeof p === "string" || p instanceof Buffer))) { throw new Error(`Invalid arguments`) }
@@ -47,7 +62,9 @@ express()
                 // TODO:
                 if (statement.reader) {
                     const columns = (statement.columns() as { name: string, column: string | null, table: string | null, database: string | null, type: string | null }[]).map(({ name }) => name)
-                    res.send(packr.pack({ columns, records: statement.all(...query.params) }))
+                    const records = statement.raw(true).all(...query.params) as unknown[][]
+                    // A single chunk without typed arrays. See write_query_result() in ../vscode/server.py for the format.
+                    res.send(packr.pack({ columns, chunks: [{ dtypes: columns.map(() => null), data: columns.map((_, i) => records.map((record) => record[i])) }] }))
                 } else {
                     statement.run(...query.params)
                     res.send(packr.pack(undefined))
@@ -92,9 +92,47 @@ type QueryResult<T extends string> = Promise<{
     records: T extends `SELECT ${string}` | `PRAGMA pragma_list` ? Record<string, SQLite3Value>[] : (Record<string, SQLite3Value>[] | undefined)
 }>
 
+/**
+ * A chunk of query results. `data[i]` contains the values of the i-th column, encoded as a little-endian typed array if `dtypes[i]` is not null.
+ * Integer columns are narrowed to the smallest type that can hold their values, and real columns are sent as float32 if it is lossless.
+ */
+type QueryResultChunk = { dtypes: ("i1" | "i2" | "i4" | "i8" | "f4" | "f8" | null)[], data: (Uint8Array | SQLite3Value[])[] }
+
+/** Decodes a column in a chunk of query results. */
+const decodeColumn = (dtype: QueryResultChunk["dtypes"][number], data: QueryResultChunk["data"][number]): ArrayLike<SQLite3Value> => {
+    if (dtype === null) { return data as SQLite3Value[] }
+    const buffer = new Uint8Array(data as Uint8Array).buffer  // copy to align the buffer for the typed array
+    switch (dtype) {
+        // INTEGER values are represented as bigint regardless of their size
+        case "i1": return Array.from(new Int8Array(buffer), (x) => BigInt(x))
+        case "i2": return Array.from(new Int16Array(buffer), (x) => BigInt(x))
+        case "i4": return Array.from(new Int32Array(buffer), (x) => BigInt(x))
+        case "i8": return new BigInt64Array(buffer)
+        case "f4": return new Float32Array(buffer)
+        case "f8": return new Float64Array(buffer)
+    }
+}
+
 /** Queries the database, and commits if `mode` is "w+". */
-export const query = <T extends string>(query: T, params: readonly SQLite3Value[], mode: "r" | "w+", opts: PostOptions = {}): QueryResult<T> =>
-    post(`/query`, { query, params, mode }, opts)
+export const query = async <T extends string>(query: T, params: readonly SQLite3Value[], mode: "r" | "w+", opts: PostOptions = {}): QueryResult<T> => {
+    // The server sends records column by column in chunks to avoid repeating the column names in every record and to send numeric columns as typed arrays.
+    const res = await post(`/query`, { query, params, mode }, opts) as { columns: string[], chunks: QueryResultChunk[] } | null | undefined
+    if (!res) { return res as unknown as Awaited<QueryResult<T>> }
+    const { columns, chunks } = res
+    const records: Record<string, SQLite3Value>[] = []
+    for (const { dtypes, data } of chunks) {
+        const values = data.map((column, i) => decodeColumn(dtypes[i]!, column))
+        const numRecords = values[0]?.length ?? 0
+        for (let row = 0; row < numRecords; row++) {
+            records.push(Object.fromEntries(columns.map((column, i) => [column, values[i]![row] as SQLite3Value])))
+        }
+    }
+    return { columns, records } as Awaited<QueryResult<T>>
+}
+
+/** Executes the statements in a single transaction. */
+export const batch = (statements: readonly (readonly [query: string, params: readonly SQLite3Value[]])[], opts: PostOptions = {}) =>
+    post(`/query`, { batch: statements, mode: "w+" }, opts) as Promise<void>
 
 /** Imports a BLOB from a file. */
 export const import_ = (filepath: string, opts: PostOptions = {}) =>
@@ -1,6 +1,5 @@
 import vscode from "vscode"
 import { spawn, spawnSync } from "child_process"
-import { temporaryFile } from "tempy"
 import fs from "fs"
 import path from "path"
 import which from "which"
@@ -9,20 +8,26 @@ import { Packr, Unpackr } from "msgpackr"
 const packr = new Packr({ useRecords: false, preserveNumericTypes: true })
 const unpackr = new Unpackr({ largeBigIntToFloat: false, int64AsNumber: false, mapsAsObjects: true, useRecords: true, preserveNumericTypes: true })
 
+/** Communicates with server.py through its stdin and stdout using length-prefixed frames. */
 class LocalPythonClient {
     readonly #p
-    readonly #requestBody = temporaryFile({ extension: "msgpack" })
-    readonly #responseBody = temporaryFile({ extension: "msgpack" })
 
-    #resolve!: (data: Buffer) => void
-    #reject!: (message: Error) => void
+    /** The callbacks of the requests waiting for responses and the bodies of the partial frames received for them, keyed by request IDs. The server may respond out of order. */
+    readonly #requests = new Map<number, { resolve: (data: Buffer) => void, reject: (err: Error) => void, partialBodies: Buffer[] }>()
+    /** Set when the process has exited or failed to start. */
+    #exitError: Error | undefined
+    #nextRequestId = 0
+
+    /** The chunks of the response frames received so far */
+    #chunks = new Array<Buffer>()
+    #received = 0
+    /** The size of the frame being received, or undefined if its header hasn't been received yet. */
+    #frameSize: number | undefined
 
     constructor(pythonPath: string, serverScriptPath: string, databasePath: string, cwd: string) {
         this.#p = spawn(pythonPath, [
             serverScriptPath,
             "--database-filepath", databasePath,
-            "--request-body-filepath", this.#requestBody,
-            "--response-body-filepath", this.#responseBody,
             "--cwd", cwd,
         ])
         this.#p.stderr.on("data", (err: Buffer) => {
@@ -34,34 +39,78 @@ class LocalPythonClient {
                 console.error(errStr)
             }
         })
+        const onExit = (err: Error) => {
+            this.#exitError = err
+            for (const { reject } of this.#requests.values()) { reject(err) }
+            this.#requests.clear()
+        }
+        this.#p.on("error", onExit)
+        this.#p.on("exit", (code, signal) => { onExit(new Error(`The Python process exited unexpectedly (code: ${code}, signal: ${signal}).`)) })
+        this.#p.stdin.on("error", (err) => { console.error(err) })  // e.g. EPIPE after the process has exited, which is handled above
         this.#p.stdout.on("data", (data: Buffer) => {
-            const status = +data.toString().trim()
-            if (status === 400) {
-                this.#reject(new Error(fs.readFileSync(this.#responseBody).toString()))
-            } else if (status === 200) {
-                this.#resolve(fs.readFileSync(this.#responseBody))
+            // Response frame: request_id: uint32, status: uint16, length: uint32, body: bytes[length]
+            // Frames with the status 206 are parts of a response, whose bodies are appended to the body of the final frame.
+            this.#chunks.push(data)
+            this.#received += data.length
+            while (true) {
+                if (this.#frameSize === undefined) {
+                    if (this.#received < 10) { return }
+                    if (this.#chunks[0]!.length < 10) { this.#chunks = [Buffer.concat(this.#chunks)] }
+                    this.#frameSize = 10 + this.#chunks[0]!.readUInt32BE(6)
+                }
+                if (this.#received < this.#frameSize) { return }
+                const buf = this.#chunks.length === 1 ? this.#chunks[0]! : Buffer.concat(this.#chunks)
+                const requestId = buf.readUInt32BE(0)
+                const status = buf.readUInt16BE(4)
+                const body = buf.subarray(10, this.#frameSize)
+                const rest = buf.subarray(this.#frameSize)
+                this.#chunks = rest.length > 0 ? [rest] : []
+                this.#received = rest.length
+                this.#frameSize = undefined
+
+                const callbacks = this.#requests.get(requestId)
+                if (callbacks === undefined) { continue }
+                if (status === 206) {
+                    callbacks.partialBodies.push(body)
+                    continue
+                }
+                this.#requests.delete(requestId)
+                if (status === 400) {
+                    callbacks.reject(new Error(body.toString()))
+                } else if (status === 200) {
+                    callbacks.resolve(callbacks.partialBodies.length > 0 ? Buffer.concat([body, ...callbacks.partialBodies]) : body)
+                }
             }
         })
     }
 
-    #queue = new Array<() => void>()
     request(url: string, body: Buffer | Uint8Array, resolve: (data: Buffer) => void, reject: (err: Error) => void) {
-        const job = () => {
-            fs.writeFileSync(this.#requestBody, body)
-            this.#resolve = (data) => { resolve(data); this.#queue.shift(); this.#queue[0]?.() }
-            this.#reject = (err) => { reject(err); this.#queue.shift(); this.#queue[0]?.() }
-            this.#p.stdin.write(url + "\n")
-        }
-        this.#queue.push(job)
-        if (this.#queue.length === 1) {
-            this.#queue[0]!()
+        if (this.#exitError) {
+            reject(this.#exitError)
+            return
         }
+        const requestId = this.#nextRequestId
+        this.#nextRequestId = (this.#nextRequestId + 1) >>> 0
+        this.#requests.set(requestId, { resolve, reject, partialBodies: [] })
+
+        // Request frame: request_id: uint32, path_length: uint32, body_length: uint32, path: utf8[path_length], body: bytes[body_length]
+        const path = Buffer.from(url)
+        const header = Buffer.alloc(12)
+        header.writeUInt32BE(requestId, 0)
+        header.writeUInt32BE(path.length, 4)
+        header.writeUInt32BE(body.length, 8)
+        this.#p.stdin.write(header)
+        this.#p.stdin.write(path)
+        this.#p.stdin.write(body)
     }
 
     close() {
-        fs.rmSync(this.#requestBody, { force: true })
-        fs.rmSync(this.#responseBody, { force: true })
-        this.#p.kill()
+        this.#p.stdin.end()  // The server checkpoints the WAL and exits on EOF
+        // Kill the process if it is stuck, e.g. in a statement that ignores the interrupt
+        const timer = setTimeout(() => {
+            if (this.#p.exitCode === null && this.#p.signalCode === null) { this.#p.kill() }
+        }, 5000)
+        this.#p.once("exit", () => { clearTimeout(timer) })
     }
 }
 
@@ -96,7 +145,13 @@ export const activate = (context: vscode.ExtensionContext) => {
                 }
                 if (uri.scheme === "file") {
                     const conn = new LocalPythonClient(pythonPath, context.asAbsolutePath("server.py"), uri.fsPath, path.dirname(uri.fsPath))
-                    const watcher = fs.watch(uri.fsPath)
+                    // In WAL mode, commits by other processes only modify the -wal file, which may not exist yet. So the directory is watched instead of the files.
+                    const filenames = [path.basename(uri.fsPath), path.basename(uri.fsPath) + "-wal"]
+                    const watcher = fs.watch(path.dirname(uri.fsPath))
+                    const onDidChangeDatabase = new vscode.EventEmitter<void>()
+                    watcher.on("change", (_, filename) => {
+                        if (filename === null || filenames.includes(filename.toString())) { onDidChangeDatabase.fire() }
+                    })
                     return {
                         uri,
                         unsupportedScheme: false,
@@ -104,9 +159,10 @@ export const activate = (context: vscode.ExtensionContext) => {
                             conn.close()
                             watcher.removeAllListeners()
                             watcher.close()
+                            onDidChangeDatabase.dispose()
                         },
                         conn,
-                        watcher,
+                        onDidChangeDatabase: onDidChangeDatabase.event,
                     }
                 } else {  // unsupportedScheme such as the diff view.
                     return {
@@ -158,16 +214,17 @@ export const activate = (context: vscode.ExtensionContext) => {
                     }
                 }))
 
-                document.watcher.on("change", () => {
+                const listener = document.onDidChangeDatabase(() => {
                     webviewPanel.webview.postMessage({ type: "sqlite3-editor-server" })
                 })
+                webviewPanel.onDidDispose(() => { listener.dispose() })
             },
         } /* satisfies */ as vscode.CustomReadonlyEditorProvider<vscode.Disposable & (
             | {
                 uri: vscode.Uri
                 unsupportedScheme: false
                 conn: LocalPythonClient
-                watcher: fs.FSWatcher
+                onDidChangeDatabase: vscode.Event<void>
             }
             | {
                 uri: vscode.Uri
@@ -1,86 +1,580 @@
 import argparse
+import array
+import concurrent.futures
+import functools
+import io
+import itertools
+import mmap
 import os
+import queue
 import re
 import sqlite3
+import stat
+import struct
 import sys
+import threading
 import traceback
+import types
 import urllib.parse
 
-from umsgpack import pack, unpack
+try:
+    import msgspec
+except ImportError:  # msgspec is an optional dependency, fall back to the bundled pure-Python implementation
+    msgspec = None
 
+if msgspec is not None:
+    from typing import List, Literal, Optional, Tuple
+
+    class QueryRequest(msgspec.Struct):
+        """Either `query` and `params`, or `batch` for mode "w+". The types of the parameters are checked by SQLite
+        because msgspec doesn't support unions of str and bytes."""
+        mode: Literal["r", "w+"]
+        query: Optional[str] = None
+        params: list = []
+        batch: Optional[List[Tuple[str, list]]] = None
+
+    class ImportRequest(msgspec.Struct):
+        filepath: str
+
+    class ExportRequest(msgspec.Struct):
+        filepath: str
+        data: bytes
+
+    # Decoding directly into the request types validates them without creating intermediate dicts
+    request_decoders = {
+        "/query": msgspec.msgpack.Decoder(QueryRequest),
+        "/import": msgspec.msgpack.Decoder(ImportRequest),
+        "/export": msgspec.msgpack.Decoder(ExportRequest),
+    }
+
+    def decode_request(path: str, buf):
+        if path not in request_decoders:
+            raise Exception("Invalid path: " + path)
+        return request_decoders[path].decode(buf)
+
+    _encoder = msgspec.msgpack.Encoder()
+
+    def encode_into(obj, buf: bytearray):
+        """Appends the encoded `obj` to `buf`."""
+        _encoder.encode_into(obj, buf, -1)
+else:
+    from umsgpack import packb, unpackb
+
+    # The default values of optional fields, see the request types above
+    request_defaults = {
+        "/query": {"query": None, "params": [], "batch": None},
+        "/import": {},
+        "/export": {},
+    }
+
+    def decode_request(path: str, buf):
+        if path not in request_defaults:
+            raise Exception("Invalid path: " + path)
+        return types.SimpleNamespace(**{**request_defaults[path], **unpackb(bytes(buf))})  # umsgpack doesn't accept memoryviews
+
+    def encode_into(obj, buf: bytearray):
+        """Appends the encoded `obj` to `buf`."""
+        buf += packb(obj)
+
+try:
+    import re2  # RE2 runs in linear time and doesn't suffer from catastrophic backtracking
+except ImportError:  # google-re2 is an optional dependency
+    re2 = None
+
+try:
+    import apsw  # binds SQLite more thinly than the sqlite3 module, which reduces the per-statement overhead
+except ImportError:  # apsw is an optional dependency
+    apsw = None
+
+# The base classes of the exceptions raised by SQLite with either module
+DatabaseError = (sqlite3.Error, apsw.Error) if apsw is not None else sqlite3.Error
+
+RECORDS_CHUNK_SIZE = 4096
+
+REQUEST_HEADER = struct.Struct(">III")  # request_id, path_length, body_length
+RESPONSE_HEADER = struct.Struct(">IHI")  # request_id, status, length
+
+
+def connect(uri: str):
+    """Opens a connection with apsw if it is available, or with the sqlite3 module otherwise. Transactions are never opened implicitly."""
+    if apsw is not None:
+        return apsw.Connection(uri, flags=apsw.SQLITE_OPEN_URI | apsw.SQLITE_OPEN_READWRITE | apsw.SQLITE_OPEN_CREATE, statementcachesize=256)
+    # sqlite3 reuses prepared statements keyed by the query string. The table viewer repeats the same queries while paging, so keep more of them than the default 128.
+    # check_same_thread=False is safe because each connection is only used by one thread at a time.
+    con = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=256)
+    con.isolation_level = None
+    return con
+
+
+def create_function(con, name: str, num_params: int, func):
+    if apsw is not None:
+        con.createscalarfunction(name, func, num_params, deterministic=True)
+    elif sys.version_info >= (3, 8, 3):  # `deterministic` is added in 3.8.3 https://docs.python.org/3/library/sqlite3.html#sqlite3.Connection.create_function
+        con.create_function(name, num_params, func, deterministic=True)
+    else:
+        con.create_function(name, num_params, func)
+
+
+SQL_WHITESPACE_OR_COMMENT = re.compile(r"\s+|--[^\n]*|/\*.*?(?:\*/|\Z)", re.DOTALL)
+
+
+def has_more_statements(query: str, pos: int) -> bool:
+    """Tests whether anything other than whitespace and comments follows `pos` in the query."""
+    while pos < len(query):
+        m = SQL_WHITESPACE_OR_COMMENT.match(query, pos)
+        if m is None:
+            return True
+        pos = m.end()
+    return False
+
+
+def apsw_cursor(con, query: str, descriptions: list):
+    """Returns an apsw cursor that rejects queries that consist of more than one statement before executing them, like the sqlite3 module does.
+    apsw would execute all of them otherwise. The description of the statement is appended to `descriptions` before it is executed."""
+    cursor = con.cursor()
+
+    def exec_trace(cursor, sql, bindings):
+        if not descriptions:  # `sql` is the first statement of the query, including the semicolons after it
+            if has_more_statements(query, len(sql)):
+                return False  # raises apsw.ExecTraceAbort
+            # apsw only provides the description of a statement while it is being executed. Otherwise queries returning no rows would have no columns.
+            descriptions.append(cursor.getdescription())
+        return True
+    cursor.setexectrace(exec_trace)
+    return cursor
+
+
+def execute(con, query: str, params):
+    """Executes the query and returns `(columns, records)` where `columns` is None if the statement doesn't return rows, e.g. INSERT."""
+    if apsw is not None:
+        descriptions = []
+        cursor = apsw_cursor(con, query, descriptions)
+        try:
+            cursor.execute(query, params)
+        except apsw.ExecTraceAbort:
+            raise Exception("You can only execute one statement at a time.") from None
+        description = descriptions[0] if descriptions else None
+    else:
+        cursor = con.execute(query, params)
+        description = cursor.description
+    if not description:  # is None (sqlite3) or empty (apsw) when inserting, updating, etc.
+        return None, cursor
+    return [desc[0] for desc in description], cursor
+
+
+def executemany(con, query: str, params_list):
+    if apsw is not None:
+        try:
+            for _ in apsw_cursor(con, query, []).executemany(query, params_list):
+                pass
+        except apsw.ExecTraceAbort:
+            raise Exception("You can only execute one statement at a time.") from None
+    else:
+        con.executemany(query, params_list)
+
+
+# The narrowest typed arrays that can hold the integers in a column, (dtype, typecode, min, max)
+INTEGER_DTYPES = [("i1", "b", -2 ** 7, 2 ** 7 - 1), ("i2", "h", -2 ** 15, 2 ** 15 - 1), ("i4", "i", -2 ** 31, 2 ** 31 - 1), ("i8", "q", -2 ** 63, 2 ** 63 - 1)]
+
+
+def encode_column(values):
+    """Encodes the values of a column in a chunk as a little-endian typed array if they are all INTEGER or all REAL.
+
+    Integers are stored in the narrowest of int8/int16/int32/int64 that can hold them, and reals are stored as float32 if
+    it represents all of them exactly. Returns `(dtype, data)` where `dtype` is "i1", "i2", "i4", "i8", "f4", "f8", or None
+    if `data` is the list of values as is."""
+    value_types = set(map(type, values))
+    if value_types == {int}:
+        lo, hi = min(values), max(values)
+        dtype, typecode = next((dtype, typecode) for dtype, typecode, min_, max_ in INTEGER_DTYPES if min_ <= lo and hi <= max_)
+        data = array.array(typecode, values)
+    elif value_types == {float}:
+        data = array.array("f", values)
+        if data.tolist() == list(values):  # lossless
+            dtype = "f4"
+        else:
+            data = array.array("d", values)
+            dtype = "f8"
+    else:
+        return None, values
+    if sys.byteorder == "big":
+        data.byteswap()
+    return dtype, data.tobytes()
+
+
+def write_query_result(frame: bytearray, columns, records, write_partial):
+    """Writes the result of a query as MessagePack while only holding `RECORDS_CHUNK_SIZE` records in memory at a time.
+
+    Records are sent column by column in chunks: `{ columns: string[], chunks: { dtypes: (string | null)[], data: (Uint8Array | SQLite3Value[])[] }[] }`,
+    where `data[i]` contains the values of `columns[i]` as a typed array if `dtypes[i]` is not null, so that numeric columns don't need per-value decoding.
+
+    The header and the first chunk are appended to `frame`, which is the final frame of the response. Every following chunk is
+    passed to `write_partial()` in a frame of its own as soon as it is encoded, because the number of chunks in the header is
+    only known at the end. The body of the response is the body of the final frame followed by the bodies of the partial frames."""
+    frame += b"\x82"  # fixmap with 2 entries
+    encode_into("columns", frame)
+    encode_into(columns, frame)
+    encode_into("chunks", frame)
+
+    # array32 header, whose length is filled in after all chunks are written
+    header_offset = len(frame)
+    frame += b"\xdd\x00\x00\x00\x00"
+
+    num_chunks = 0
+    while True:
+        chunk = list(itertools.islice(records, RECORDS_CHUNK_SIZE))
+        if not chunk:
+            break
+        dtypes, data = zip(*(encode_column(values) for values in zip(*chunk)))
+        if num_chunks == 0:
+            encode_into({"dtypes": dtypes, "data": data}, frame)
+        else:
+            partial = new_frame()
+            encode_into({"dtypes": dtypes, "data": data}, partial)
+            write_partial(partial)
+        num_chunks += 1
+
+    struct.pack_into(">I", frame, header_offset + 1, num_chunks)
+
+
+# Characters that make a find widget pattern a regular expression rather than a plain string. `re.escape(pattern) == pattern` is not used
+# because re.escape() also escapes spaces and, before Python 3.7, every non-alphanumeric character.
+REGEXP_SPECIAL_CHARACTERS = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+# Character classes that RE2 only matches against ASCII characters, unlike `re`. This also matches an escaped backslash followed by e.g. `w`,
+# which is harmless because `re` is used for such patterns.
+ASCII_ONLY_IN_RE2 = re.compile(r"\\[bBwWdDsS]")
+
+
+@functools.lru_cache(maxsize=64)
+def compile_find_widget_regexp(pattern: str, whole_word: int, case_sensitive: int):
+    """Returns a function that tests whether the text matches the pattern, or None for invalid regular expressions.
+
+    The result is cached so that the pattern is compiled once instead of once per row."""
+    if not whole_word and REGEXP_SPECIAL_CHARACTERS.search(pattern) is None:
+        # Plain substring search is faster than any regex engine
+        if case_sensitive:
+            return lambda text: pattern in text
+        pattern_lower = pattern.lower()
+        return lambda text: pattern_lower in text.lower()
+
+    if whole_word:
+        pattern = f"\\b(?:{pattern})\\b"
+
+    # Whole word matching also relies on \b, which would miss words in e.g. Japanese text
+    if re2 is not None and ASCII_ONLY_IN_RE2.search(pattern) is None:
+        options = re2.Options()
+        options.case_sensitive = bool(case_sensitive)
+        options.log_errors = False
+        try:
+            return re2.compile(pattern, options).search
+        except re2.error:  # RE2 doesn't support backreferences, lookarounds, etc.
+            pass
 
-def find_widget_regexp(text: str, pattern: str, whole_word: int, case_sensitive: int):
     try:
-        return 0 if re.search(pattern, "\\b(?:{pattern})\\b" if whole_word else text, 0 if case_sensitive else re.RegexFlag.I) is None else 1
-    except re.error:  # Invalid regular expressions
+        return re.compile(pattern, 0 if case_sensitive else re.RegexFlag.I).search
+    except re.error:
+        return None
+
+
+def find_widget_regexp(text, pattern: str, whole_word: int, case_sensitive: int):
+    search = compile_find_widget_regexp(pattern, whole_word, case_sensitive)
+    if search is None:
         return 0
+    # INTEGER, REAL, and BLOB values are passed as is, e.g. by `IFNULL(column, 'NULL')`
+    if isinstance(text, bytes):
+        text = text.decode(errors="replace")
+    elif not isinstance(text, str):
+        text = str(text)
+    return 1 if search(text) else 0
+
+
+def new_frame():
+    """Returns a buffer for a response frame with room for its header. The body is appended to it, and the header is filled in by write_frame()."""
+    return bytearray(RESPONSE_HEADER.size)
+
+
+def write_frame(out, request_id: int, status: int, frame: bytearray):
+    """Fills in the header of a frame created by new_frame() and writes the whole frame with a single write()."""
+    RESPONSE_HEADER.pack_into(frame, 0, request_id, status, len(frame) - RESPONSE_HEADER.size)
+    out.write(frame)
+    out.flush()
+
+
+def write_file_frame(out, request_id: int, fd: int):
+    """Writes a frame whose body is the content of the file `fd` encoded as a MessagePack bin, without reading the file into memory."""
+    st = os.fstat(fd)
+    if not stat.S_ISREG(st.st_mode):
+        raise Exception("Not a regular file")
+    size = st.st_size
+    if hasattr(os, "posix_fadvise"):  # Not available on Windows and macOS
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+
+    # Nothing below may raise once the header is written, because the caller would write an error frame in the middle of this one
+    header = RESPONSE_HEADER.pack(request_id, 200, 5 + size) + b"\xc6" + struct.pack(">I", size)  # bin32
+    out.write(header)
+    out.flush()
+
+    offset = 0
+    try:
+        out_fd = out.fileno()
+        while offset < size:
+            sent = os.sendfile(out_fd, fd, offset, size - offset)
+            if sent == 0:
+                break
+            offset += sent
+    except (AttributeError, OSError, io.UnsupportedOperation):  # os.sendfile() is not available on Windows and only supports sockets on macOS
+        try:
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as m:
+                chunk = memoryview(m)[offset:size]
+                out.write(chunk)
+                offset += len(chunk)
+                chunk.release()
+        except (ValueError, OSError):  # e.g. the file is empty, or was truncated to 0 bytes after fstat(), and cannot be mapped
+            pass
+
+    # Keep the frame length valid even if the file is truncated while copying
+    out.write(bytes(size - offset))
+    out.flush()
+
+
+def int_from_env(name: str, default: int, minimum: int):
+    """Reads an integer that is at least `minimum` from an environment variable, or returns `default` if it is unset or invalid."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        if int(value) >= minimum:
+            return int(value)
+    except ValueError:
+        pass
+    print(f"Ignoring {name}={value!r}, which must be an integer greater than or equal to {minimum}", file=sys.stderr)
+    return default
 
 
 class Server:
-    def __init__(self, database_filepath, request_body_filepath, response_body_filepath, cwd):
-        self.readonly_connection = sqlite3.connect("file:" + urllib.parse.quote(database_filepath) + "?mode=ro", uri=True)
-        self.readwrite_connection = sqlite3.connect(database_filepath)
+    def __init__(self, database_filepath, cwd):
+        # Memory-map the database file. Can be lowered with SQLITE3_EDITOR_MMAP_SIZE on low-memory hosts.
+        self.mmap_size = int_from_env("SQLITE3_EDITOR_MMAP_SIZE", 256 * 1024 * 1024, 0)
 
-        if sys.version_info >= (3, 8, 3):  # `deterministic` is added in 3.8.3 https://docs.python.org/3/library/sqlite3.html#sqlite3.Connection.create_function
-            self.readonly_connection.create_function("find_widget_regexp", 4, find_widget_regexp, deterministic=True)
-            self.readwrite_connection.create_function("find_widget_regexp", 4, find_widget_regexp, deterministic=True)
+        in_memory = database_filepath == ":memory:"
+        if in_memory:
+            # A database that lives as long as this server, e.g. for tests. The memdb VFS (SQLite 3.36+) shares it between the connections,
+            # but it doesn't support WAL, so reads fail with SQLITE_BUSY while the client has a write transaction open.
+            database_uri = f"file:/sqlite3-editor-{id(self)}?vfs=memdb"
         else:
-            self.readonly_connection.create_function("find_widget_regexp", 4, find_widget_regexp)
-            self.readwrite_connection.create_function("find_widget_regexp", 4, find_widget_regexp)
+            database_uri = "file:" + urllib.parse.quote(database_filepath)
+
+        # Writes commit immediately, batches are wrapped in a savepoint by execute_batch(), and the client can send BEGIN and COMMIT itself.
+        self.readwrite_connection = connect(database_uri)
+
+        # WAL with synchronous=NORMAL avoids an fsync per committed transaction. journal_mode is persistent and cannot be set on the read-only connections,
+        # so the original one is restored by close().
+        self.original_journal_mode = None
+        try:
+            if not in_memory:
+                journal_mode = self.readwrite_connection.execute("PRAGMA journal_mode").fetchone()[0]
+                if journal_mode.lower() != "wal" and self.readwrite_connection.execute("PRAGMA journal_mode=WAL").fetchone()[0].lower() == "wal":
+                    self.original_journal_mode = journal_mode
+            self.readwrite_connection.execute("PRAGMA synchronous=NORMAL")
+            self.readwrite_connection.execute("PRAGMA journal_size_limit=6144000")
+        except DatabaseError:  # SQLite opens the database read-only if the file is not writable, e.g. it is immutable or on a read-only mount
+            pass  # keep the current journal mode
+        self.setup_connection(self.readwrite_connection)
+        if not in_memory and self.mmap_size > 0 and self.readwrite_connection.execute("PRAGMA mmap_size").fetchone()[0] == 0:
+            print("mmap is not supported by this SQLite build (SQLITE_MAX_MMAP_SIZE=0)", file=sys.stderr)
+
+        # A pool of read-only connections so that reads, e.g. a slow query and an /import, don't block each other.
+        num_readonly_connections = int_from_env("SQLITE3_EDITOR_READONLY_CONNECTIONS", 4, 1)
+        self.readonly_connections = queue.Queue()
+        self.all_readonly_connections = []  # including the ones that are checked out of the queue, for close()
+        for _ in range(num_readonly_connections):
+            con = connect(database_uri + ("&" if in_memory else "?") + "mode=ro")
+            self.setup_connection(con)
+            self.readonly_connections.put(con)
+            self.all_readonly_connections.append(con)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_readonly_connections)
+        self.pending = []
+        self.out_lock = threading.Lock()
 
-        self.request_body_filepath = request_body_filepath
-        self.response_body_filepath = response_body_filepath
         self.cwd = cwd
 
-    def handle(self, path):
-        path = path.strip()
+    def setup_connection(self, con):
+        con.execute("PRAGMA temp_store=MEMORY")
+        con.execute("PRAGMA cache_size=-20000")  # 20 MiB
+        con.execute(f"PRAGMA mmap_size={self.mmap_size}")
+
+        create_function(con, "find_widget_regexp", 4, find_widget_regexp)
+
+    def handle(self, request_id, path, request_body, out):
+        """Handles a request and writes the response to `out` as a frame of `request_id: uint32, status: uint16, length: uint32, body: bytes[length]`.
+
+        The status is 200 or 400. Query results can be preceded by frames with the status 206, whose bodies are appended to the body
+        of the final frame, see write_query_result().
+
+        Read-only requests run concurrently on the pool of read-only connections. Other requests wait for them to finish
+        and are executed on the calling thread, so that every request observes the writes sent before it."""
         try:
-            with open(self.request_body_filepath, "rb") as f:
-                request_body = unpack(f)
+            request_body = decode_request(path, request_body)
+            readonly = path == "/import" or (path == "/query" and request_body.mode == "r")
+        except Exception as err:
+            traceback.print_exc(file=sys.stderr)
+            with self.out_lock:
+                write_frame(out, request_id, 400, new_frame() + str(err).encode())
+            return
+
+        if readonly:
+            self.pending = [future for future in self.pending if not future.done()]
+            self.pending.append(self.executor.submit(self.execute, request_id, path, request_body, out))
+        else:
+            concurrent.futures.wait(self.pending)
+            self.pending = []
+            self.execute(request_id, path, request_body, out)
 
-            response_body = None
+    def handle_bytes(self, path: str, request_body: bytes) -> bytes:
+        """Handles a single request and returns the body of the response, without going through the frames on stdin and stdout."""
+        out = io.BytesIO()
+        self.handle(0, path, request_body, out)
+        concurrent.futures.wait(self.pending)
+        buf = out.getvalue()
+        partial_bodies = []
+        offset = 0
+        while True:
+            _, status, length = RESPONSE_HEADER.unpack_from(buf, offset)
+            offset += RESPONSE_HEADER.size + length
+            body = buf[offset - length:offset]
+            if status == 206:
+                partial_bodies.append(body)
+            elif status == 200:
+                return body + b"".join(partial_bodies)
+            else:
+                raise Exception(body.decode())
 
-            if path == "/query":
+    def execute(self, request_id, path, request_body, out):
+        frame = new_frame()
+        try:
+            if path == "/query" and request_body.batch is not None:
+                # { batch: [query: string, params: (number | bigint | string | Uint8Array | Buffer)[]][], mode: "w+" }
+                if request_body.mode != "w+":
+                    raise Exception("batch requires mode w+")
+                self.execute_batch(request_body.batch)
+                encode_into(None, frame)
+            elif path == "/query":
                 # { query: string, params: (number | bigint | string | Uint8Array | Buffer)[], mode: "w+" | "r" }
                 try:
-                    if request_body["mode"] == "w+":
-                        with self.readwrite_connection as con:
-                            con.execute(request_body["query"], request_body["params"])
+                    if request_body.mode == "w+":
+                        # Commits immediately unless the client has started a transaction with BEGIN
+                        for _ in execute(self.readwrite_connection, request_body.query, request_body.params)[1]:
+                            pass  # apsw only steps until the first row, e.g. of a RETURNING clause
+                        encode_into(None, frame)
                     else:
-                        cursor = self.readonly_connection.execute(request_body["query"], request_body["params"])
-                        if cursor.description is not None:  # is None when inserting, updating, etc.
-                            columns = [desc[0] for desc in cursor.description]
-                            response_body = {"columns": columns, "records": [{k: v for k, v in zip(columns, record)} for record in cursor.fetchall()]}
+                        con = self.readonly_connections.get()
+                        try:
+                            columns, records = execute(con, request_body.query, request_body.params)
+                            if columns is not None:
+                                def write_partial(partial):
+                                    with self.out_lock:
+                                        write_frame(out, request_id, 206, partial)
+                                write_query_result(frame, columns, records, write_partial)
+                            else:
+                                encode_into(None, frame)
+                        finally:
+                            self.readonly_connections.put(con)
                 except Exception as err:
-                    raise Exception(f"{err}\nQuery: {request_body['query']}\nParams: {request_body['params']}")
+                    raise Exception(f"{err}\nQuery: {request_body.query}\nParams: {request_body.params}")
             elif path == "/import":
                 # { filepath: string }
-                with open(os.path.join(self.cwd, request_body["filepath"]), "rb") as f:
-                    response_body = bytearray(f.read())
+                fd = os.open(os.path.join(self.cwd, request_body.filepath), os.O_RDONLY | getattr(os, "O_BINARY", 0))
+                try:
+                    with self.out_lock:
+                        write_file_frame(out, request_id, fd)
+                finally:
+                    os.close(fd)
+                return
             elif path == "/export":
                 # { filepath: string, data: Uint8Array | Buffer }
-                with open(os.path.join(self.cwd, request_body["filepath"]), "wb") as f:
-                    f.write(request_body["data"])
-            else:
-                raise Exception("Invalid path: " + path)
+                data = request_body.data
+                with open(os.path.join(self.cwd, request_body.filepath), "wb") as dst:
+                    dst.write(data)
+                encode_into(None, frame)
         except Exception as err:
             traceback.print_exc(file=sys.stderr)
-            with open(self.response_body_filepath, "w") as f:
-                f.write(str(err))
-            return 400
+            with self.out_lock:
+                write_frame(out, request_id, 400, new_frame() + str(err).encode())
         else:
-            with open(self.response_body_filepath, "wb") as f:
-                pack(response_body, f)
-            return 200
+            with self.out_lock:
+                write_frame(out, request_id, 200, frame)
+
+    def execute_batch(self, batch):
+        """Executes the statements atomically in a savepoint, which starts a transaction unless the client has sent BEGIN.
+
+        Consecutive statements with the same query are executed with executemany()."""
+        con = self.readwrite_connection
+        con.execute("SAVEPOINT batch")
+        try:
+            for query, group in itertools.groupby(batch, key=lambda statement: statement[0]):
+                params = [params for _, params in group]
+                try:
+                    if len(params) == 1:
+                        for _ in execute(con, query, params[0])[1]:
+                            pass  # apsw only steps until the first row
+                    else:
+                        executemany(con, query, params)
+                except Exception as err:
+                    raise Exception(f"{err}\nQuery: {query}\nParams: {params}")
+            con.execute("RELEASE batch")
+        except Exception:
+            try:
+                con.execute("ROLLBACK TO batch")
+                con.execute("RELEASE batch")
+            except DatabaseError:  # The batch has ended the transaction itself, e.g. with COMMIT, so the savepoint no longer exists
+                pass
+            raise
+
+    def serve(self, stdin, stdout):
+        """Reads requests from `stdin` as frames of `request_id: uint32, path_length: uint32, body_length: uint32, path: utf8[path_length], body: bytes[body_length]` until EOF."""
+        # Request bodies are read into a buffer that is reused across requests. This is safe because handle() decodes the body
+        # before returning, and the decoded request doesn't reference the buffer. Larger bodies, e.g. of /export, are read into
+        # a buffer of their own so that their memory is freed after the request.
+        buf = bytearray(65536)
+        while True:
+            header = stdin.read(REQUEST_HEADER.size)
+            if len(header) < REQUEST_HEADER.size:  # stdin is closed by the extension
+                return
+            request_id, path_length, body_length = REQUEST_HEADER.unpack(header)
+            path = stdin.read(path_length).decode()
+            with memoryview(buf if body_length <= len(buf) else bytearray(body_length))[:body_length] as body:
+                if stdin.readinto(body) < body_length:  # stdin is closed in the middle of a frame
+                    return
+                self.handle(request_id, path, body, stdout)
+
+    def close(self):
+        # Don't wait for reads that may never finish, e.g. an infinite recursive CTE
+        for future in self.pending:
+            future.cancel()
+        for con in self.all_readonly_connections:
+            con.interrupt()
+        self.executor.shutdown(wait=True)
+        # Merge the WAL back into the database file so that it doesn't leave a large -wal file behind
+        self.readwrite_connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        while not self.readonly_connections.empty():
+            self.readonly_connections.get().close()
+        if self.original_journal_mode is not None:
+            try:
+                self.readwrite_connection.execute(f"PRAGMA journal_mode={self.original_journal_mode}")
+            except DatabaseError:  # e.g. another process has the database open
+                pass
+        self.readwrite_connection.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--database-filepath", type=str, required=True)
-    parser.add_argument("--request-body-filepath", type=str, required=True)
-    parser.add_argument("--response-body-filepath", type=str, required=True)
     parser.add_argument("--cwd", type=str, required=True)
     args = parser.parse_args()
-    server = Server(args.database_filepath, args.request_body_filepath, args.response_body_filepath, args.cwd)
-    while True:
-        print(server.handle(input()), flush=True)
+    server = Server(args.database_filepath, args.cwd)
+    try:
+        server.serve(sys.stdin.buffer, sys.stdout.buffer)
+    finally:
+        server.close()
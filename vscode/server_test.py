@@ -0,0 +1,213 @@
+import array
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+import unittest.mock
+
+import server
+from umsgpack import packb, unpackb
+
+DTYPE_TYPECODES = {"i1": "b", "i2": "h", "i4": "i", "i8": "q", "f4": "f", "f8": "d"}
+
+
+def decode_column(dtype, data):
+    if dtype is None:
+        return data
+    values = array.array(DTYPE_TYPECODES[dtype])
+    values.frombytes(data)
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tolist()
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        # The server prints the tracebacks of failed requests
+        redirect_stderr = contextlib.redirect_stderr(io.StringIO())
+        redirect_stderr.__enter__()
+        self.addCleanup(redirect_stderr.__exit__, None, None, None)
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.server = server.Server(":memory:", self.tmp.name)
+
+    def tearDown(self):
+        self.server.close()
+        self.tmp.cleanup()
+
+    def request(self, path, body):
+        return unpackb(self.server.handle_bytes(path, packb(body)))
+
+    def query(self, query, params=[], mode="r"):
+        """Returns `(columns, records)` for queries returning rows, or None otherwise."""
+        result = self.request("/query", {"query": query, "params": params, "mode": mode})
+        if result is None:
+            return None
+        records = []
+        for chunk in result["chunks"]:
+            records.extend(list(record) for record in zip(*(decode_column(dtype, data) for dtype, data in zip(chunk["dtypes"], chunk["data"]))))
+        return result["columns"], records
+
+    def dtypes(self, query):
+        return self.request("/query", {"query": query, "params": [], "mode": "r"})["chunks"][0]["dtypes"]
+
+    def test_query(self):
+        self.assertIsNone(self.query("CREATE TABLE t(a, b)", mode="w+"))
+        self.assertIsNone(self.query("INSERT INTO t VALUES (?, ?), (?, ?)", [1, "x", None, b"\x00\x01"], mode="w+"))
+        self.assertEqual(self.query("SELECT * FROM t"), (["a", "b"], [[1, "x"], [None, b"\x00\x01"]]))
+
+    def test_query_error(self):
+        with self.assertRaisesRegex(Exception, "no such table: nope"):
+            self.query("SELECT * FROM nope")
+
+    def test_empty_result_has_columns(self):
+        self.query("CREATE TABLE t(a, b)", mode="w+")
+        self.assertEqual(self.query("SELECT * FROM t"), (["a", "b"], []))
+
+    def test_multiple_chunks(self):
+        n = server.RECORDS_CHUNK_SIZE * 2 + 1
+        columns, records = self.query(f"WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < {n}) SELECT x, 'r' || x FROM c")
+        self.assertEqual(columns, ["x", "'r' || x"])
+        self.assertEqual(records, [[i, f"r{i}"] for i in range(1, n + 1)])
+
+    def test_multiple_statements(self):
+        self.query("CREATE TABLE t(a)", mode="w+")
+        with self.assertRaisesRegex(Exception, "one statement at a time"):
+            self.query("SELECT 1; SELECT 2")
+        with self.assertRaisesRegex(Exception, "one statement at a time"):
+            self.query("INSERT INTO t VALUES (1); INSERT INTO t VALUES (2)", mode="w+")
+        self.assertEqual(self.query("SELECT count(*) FROM t")[1], [[0]])
+        self.assertEqual(self.query("SELECT 1; -- comment")[1], [[1]])
+
+    def test_readonly_mode_rejects_writes(self):
+        self.query("CREATE TABLE t(a)", mode="w+")
+        with self.assertRaisesRegex(Exception, "readonly"):
+            self.query("INSERT INTO t VALUES (1)")
+        self.query("PRAGMA query_only=0")
+        with self.assertRaisesRegex(Exception, "readonly"):
+            self.query("INSERT INTO t VALUES (1)")
+        self.assertEqual(self.query("SELECT count(*) FROM t")[1], [[0]])
+
+    def test_batch(self):
+        self.query("CREATE TABLE t(a UNIQUE)", mode="w+")
+        self.assertIsNone(self.request("/query", {"batch": [["INSERT INTO t VALUES (?)", [i]] for i in range(3)] + [["DELETE FROM t WHERE a = ?", [0]]], "mode": "w+"}))
+        self.assertEqual(self.query("SELECT a FROM t")[1], [[1], [2]])
+
+    def test_batch_rollback(self):
+        self.query("CREATE TABLE t(a UNIQUE)", mode="w+")
+        with self.assertRaisesRegex(Exception, "UNIQUE constraint failed"):
+            self.request("/query", {"batch": [["INSERT INTO t VALUES (?)", [1]], ["INSERT INTO t VALUES (?)", [1]]], "mode": "w+"})
+        self.assertEqual(self.query("SELECT a FROM t")[1], [])
+
+    def test_batch_rollback_in_client_transaction(self):
+        self.query("CREATE TABLE t(a UNIQUE)", mode="w+")
+        self.query("BEGIN", mode="w+")
+        self.request("/query", {"batch": [["INSERT INTO t VALUES (?)", [1]]], "mode": "w+"})
+        with self.assertRaisesRegex(Exception, "UNIQUE constraint failed"):
+            self.request("/query", {"batch": [["INSERT INTO t VALUES (?)", [2]], ["INSERT INTO t VALUES (?)", [2]]], "mode": "w+"})
+        self.query("COMMIT", mode="w+")
+        self.assertEqual(self.query("SELECT a FROM t")[1], [[1]])
+
+    def test_batch_requires_write_mode(self):
+        with self.assertRaises(Exception):
+            self.request("/query", {"batch": [["SELECT 1", []]], "mode": "r"})
+
+    def test_typed_arrays(self):
+        for dtype, values in [
+            ("i1", [-2 ** 7, 0, 2 ** 7 - 1]),
+            ("i2", [-2 ** 15, 2 ** 15 - 1]),
+            ("i4", [-2 ** 31, 2 ** 31 - 1]),
+            ("i8", [-2 ** 63, 2 ** 63 - 1]),
+            ("f4", [0.0, -1.5, 2.25]),
+            ("f8", [0.1, 1e300]),
+        ]:
+            with self.subTest(dtype=dtype):
+                query = " UNION ALL ".join(f"SELECT {value!r} AS x" for value in values)
+                self.assertEqual(self.dtypes(query), [dtype])
+                self.assertEqual(self.query(query)[1], [[value] for value in values])
+
+    def test_mixed_types_are_not_typed_arrays(self):
+        query = "SELECT 1 AS x UNION ALL SELECT 1.5 UNION ALL SELECT 'a' UNION ALL SELECT NULL"
+        self.assertEqual(self.dtypes(query), [None])
+        self.assertEqual(self.query(query)[1], [[1], [1.5], ["a"], [None]])
+
+    def test_import(self):
+        with open(os.path.join(self.tmp.name, "a.bin"), "wb") as f:
+            f.write(b"\x00\x01abc")
+        self.assertEqual(self.request("/import", {"filepath": "a.bin"}), b"\x00\x01abc")
+
+    def test_import_empty_file(self):
+        open(os.path.join(self.tmp.name, "empty"), "wb").close()
+        self.assertEqual(self.request("/import", {"filepath": "empty"}), b"")
+
+    def test_import_error(self):
+        with self.assertRaises(Exception):
+            self.request("/import", {"filepath": "nope"})
+        with self.assertRaisesRegex(Exception, "Not a regular file"):
+            self.request("/import", {"filepath": "."})
+
+    def test_import_file_truncated_after_fstat(self):
+        filepath = os.path.join(self.tmp.name, "a.bin")
+        with open(filepath, "wb") as f:
+            f.write(b"abc")
+        fd = os.open(filepath, os.O_RDWR)
+        try:
+            st = os.fstat(fd)
+            os.truncate(fd, 0)
+            out = io.BytesIO()
+            with unittest.mock.patch.object(server.os, "fstat", return_value=st):
+                server.write_file_frame(out, 1, fd)
+        finally:
+            os.close(fd)
+        self.assertEqual(out.getvalue(), server.RESPONSE_HEADER.pack(1, 200, 8) + b"\xc6\x00\x00\x00\x03" + bytes(3))
+
+    def test_export(self):
+        self.assertIsNone(self.request("/export", {"filepath": "a.bin", "data": b"\x00\x01abc"}))
+        with open(os.path.join(self.tmp.name, "a.bin"), "rb") as f:
+            self.assertEqual(f.read(), b"\x00\x01abc")
+
+    def test_invalid_path(self):
+        with self.assertRaisesRegex(Exception, "Invalid path: /nope"):
+            self.request("/nope", {})
+
+    def test_find_widget_regexp(self):
+        for text, pattern, whole_word, case_sensitive, expected in [
+            ("Hello world", "WORLD", 0, 0, 1),  # literal
+            ("Hello world", "WORLD", 0, 1, 0),
+            ("Hello world", "wor", 0, 1, 1),
+            ("Hello world", "wor", 1, 1, 0),  # whole word
+            ("Hello world", "world", 1, 1, 1),
+            ("日本語 テスト", "テスト", 1, 1, 1),
+            ("café", "caf\\w", 0, 1, 1),  # Unicode character classes
+            ("a+b", "a\\+b", 0, 1, 1),  # regular expression
+            ("aab", "a+b", 0, 1, 1),
+            ("Hello", "(", 0, 1, 0),  # invalid regular expression
+            (123, "12", 0, 1, 1),  # non-text values
+            (1.5, "1.5", 0, 1, 1),
+            (b"abc", "B", 0, 0, 1),
+        ]:
+            with self.subTest(text=text, pattern=pattern, whole_word=whole_word, case_sensitive=case_sensitive):
+                self.assertEqual(server.find_widget_regexp(text, pattern, whole_word, case_sensitive), expected)
+
+    def test_find_widget_regexp_in_query(self):
+        self.query("CREATE TABLE t(a)", mode="w+")
+        self.query("INSERT INTO t VALUES (1), (2.5), ('abc'), (x'626364'), (NULL)", mode="w+")
+        self.assertEqual(self.query("SELECT a FROM t WHERE find_widget_regexp(IFNULL(a, 'NULL'), ?, 0, 0)", ["b|1|null"])[1], [[1], ["abc"], [b"bcd"], [None]])
+
+    def test_close_restores_journal_mode(self):
+        database_filepath = os.path.join(self.tmp.name, "a.db")
+        file_server = server.Server(database_filepath, self.tmp.name)
+        self.assertEqual(file_server.readwrite_connection.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        file_server.close()
+        con = server.connect(database_filepath)
+        try:
+            self.assertEqual(con.execute("PRAGMA journal_mode").fetchone()[0], "delete")
+        finally:
+            con.close()
+        self.assertEqual(os.listdir(self.tmp.name), ["a.db"])
+
+
+if __name__ == "__main__":
+    unittest.main()